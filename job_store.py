@@ -0,0 +1,54 @@
+# job_store.py
+import json
+import collections
+from typing import Dict, Any, Tuple
+import redis.asyncio as redis
+
+class JobStore:
+    """Stores job state in Redis so every uvicorn worker sees every job, with a local write-through cache."""
+    def __init__(self, redis_url: str, ttl_seconds: int = 86400, cache_size: int = 1024):
+        # The client connects lazily on first use
+        self.redis = redis.from_url(redis_url, decode_responses=True)
+        self.ttl_seconds = ttl_seconds
+        # Jobs run in the worker that created them, so this worker's copy of its own jobs is authoritative
+        self._cache: collections.OrderedDict[str, Dict[str, Any]] = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"jobs:{job_id}"
+
+    def _remember(self, job_id: str, job: Dict[str, Any]):
+        self._cache[job_id] = job
+        self._cache.move_to_end(job_id)
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def create(self, job_id: str, job: Dict[str, Any]):
+        """Stores a new job."""
+        self._remember(job_id, job)
+        await self.redis.set(self._key(job_id), json.dumps(job), ex=self.ttl_seconds)
+
+    async def get(self, job_id: str) -> Dict[str, Any] | None:
+        """Returns a job, preferring this worker's copy over a Redis round-trip."""
+        job = self._cache.get(job_id)
+        if job is not None:
+            return job
+        # Jobs owned by other workers are always read fresh, never cached
+        payload = await self.redis.get(self._key(job_id))
+        return json.loads(payload) if payload else None
+
+    async def update(self, job_id: str, path: Tuple[str, ...], value: Any):
+        """Sets the value at `path` (e.g. ('details', 'cycle_1')) and writes the job through to Redis."""
+        job = await self.get(job_id)
+        if job is None:
+            return
+        target = job
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = value
+        self._remember(job_id, job)
+        await self.redis.set(self._key(job_id), json.dumps(job), ex=self.ttl_seconds)
+
+    async def close(self):
+        await self.redis.aclose()
@@ -1,16 +1,25 @@
 # main.py
 import yaml
 import uuid
+import heapq
 import asyncio
+import logging
 from fastapi import FastAPI, BackgroundTasks, HTTPException
 from pydantic import BaseModel
 from typing import Dict, Any
 
-from pearl_agent import PEARLAgent
-from memory import MemoryManager
+# Configured before the local imports so their import-time messages are logged too
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+from pearl_agent import PEARLAgent, TaskStatus, GEMINI_LATENCY
+from memory import MemoryManager, SemanticPromptCache
 from tools import available_tools
+from rate_limiter import RateLimiter
+from job_store import JobStore
 
 # --- App Initialization ---
+log = logging.getLogger(__name__)
+
 app = FastAPI(title="Project PEARL API", version="1.0")
 
 # --- Configuration & Global Resources ---
@@ -19,11 +28,17 @@ with open("config.yaml", "r") as f:
 
 API_KEY = config['gemini_api_key']
 
-# Global job store (in a real app, use Redis or a DB)
-jobs: Dict[str, Dict[str, Any]] = {}
+# Global job store backed by Redis so all uvicorn workers can report on every job
+job_store = JobStore(
+    redis_url=config['redis']['url'],
+    ttl_seconds=config['redis']['job_ttl_seconds']
+)
 
-# Global Semaphore to limit concurrent LLM calls across all agent runs
-API_CALL_SEMAPHORE = asyncio.Semaphore(5)
+# Global rate limiter to keep LLM calls across all agent runs within the API quota
+API_RATE_LIMITER = RateLimiter(
+    requests_per_minute=config['rate_limit']['requests_per_minute'],
+    tokens_per_minute=config['rate_limit']['tokens_per_minute']
+)
 
 # --- Pydantic Models for API ---
 class AgentRunRequest(BaseModel):
@@ -40,52 +55,110 @@ class JobStatusResponse(BaseModel):
     progress: float
     details: Dict[str, Any]
 
+# --- Shared Resources Lifecycle ---
+@app.on_event("startup")
+async def startup():
+    """Builds the process-wide memory manager and prompt cache shared by all agent runs."""
+    # Loading the index and embedding model is blocking, so it happens in a worker thread
+    app.state.memory_manager = await asyncio.to_thread(
+        MemoryManager,
+        db_directory=config['memory']['database_directory'],
+        collection_name=config['memory']['collection_name'],
+        index_type=config['memory']['index_type']
+    )
+    app.state.prompt_cache = await asyncio.to_thread(
+        SemanticPromptCache,
+        db_directory=config['memory']['database_directory'],
+        embedding_function=app.state.memory_manager.embedding_function,
+        collection_name=config['prompt_cache']['collection_name'],
+        distance_threshold=config['prompt_cache']['distance_threshold'],
+        max_entries=config['prompt_cache']['max_entries']
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Saves the shared memory manager and prompt cache to disk and closes the job store."""
+    await app.state.memory_manager.close()
+    await app.state.prompt_cache.close()
+    await job_store.close()
+    log.info("Gemini latency (seconds): %s", GEMINI_LATENCY.percentiles())
+
 # --- Background Task for PEARL cycle ---
-async def run_pearl_cycle(job_id: str, goal: str, iterations: int):
+async def run_pearl_cycle(job_id: str, goal: str, iterations: int, memory_manager: MemoryManager, prompt_cache: SemanticPromptCache):
     """The main async function to run the agent's cognitive loop."""
     try:
-        jobs[job_id]['status'] = 'in_progress'
+        await job_store.update(job_id, ('status',), 'in_progress')
         
-        memory_manager = MemoryManager(
-            db_directory=config['memory']['database_directory'],
-            collection_name=config['memory']['collection_name']
-        )
+        # Prefetch the first cycle's memories while the agent is being set up
+        memories = asyncio.create_task(memory_manager.retrieve_relevant_memories(goal))
         agent = PEARLAgent(
             api_key=API_KEY,
             model_name=config['model_name'],
             memory_manager=memory_manager,
             tools=available_tools,
-            api_call_semaphore=API_CALL_SEMAPHORE
+            rate_limiter=API_RATE_LIMITER,
+            prompt_cache=prompt_cache
         )
 
         for i in range(iterations):
-            jobs[job_id]['details'][f'cycle_{i+1}'] = {'status': 'starting'}
+            if i > 0:
+                # Started only once the previous cycle's learnings have been written
+                memories = asyncio.create_task(memory_manager.retrieve_relevant_memories(goal))
+            await job_store.update(job_id, ('details', f'cycle_{i+1}'), {'status': 'starting'})
             
-            assessment = await agent.self_assess(goal)
-            tasks = await agent.adaptive_plan(goal, assessment)
+            assessment, tasks = await agent.assess_and_plan(goal, relevant_memories=memories)
             
             cycle_results = []
-            for task in sorted(tasks, key=lambda x: x.priority, reverse=True):
-                if agent._dependencies_met(task):
-                    result = await agent.execute_goal_oriented(task)
-                    task.result = result
-                    task.status = agent.TaskStatus.COMPLETED
+            # Max-heap on priority; the sequence number breaks ties so Tasks are never compared
+            pending = [(-t.priority, n, t) for n, t in enumerate(tasks)]
+            heapq.heapify(pending)
+            while pending:
+                # A wave is every task whose dependencies are neither pending in this cycle nor unmet
+                pending_ids = {t.id for _, _, t in pending}
+                wave, deferred = [], []
+                while pending:
+                    entry = heapq.heappop(pending)
+                    task = entry[2]
+                    if agent._dependencies_met(task) and not pending_ids.intersection(task.dependencies):
+                        wave.append(task)
+                    else:
+                        deferred.append(entry)
+                if not wave:
+                    break # Remaining tasks depend on failed or cyclic tasks
+
+                # Independent tasks run concurrently; the rate limiter bounds the real API call rate
+                results = await asyncio.gather(*[agent.execute_goal_oriented(t) for t in wave], return_exceptions=True)
+                for task, result in zip(wave, results):
+                    if isinstance(result, Exception):
+                        task.result = str(result)
+                        task.status = TaskStatus.FAILED
+                    else:
+                        task.result = result
+                        task.status = TaskStatus.COMPLETED
                     agent.tasks[task.id] = task
-                    experience = await agent.integrate_experience(task)
-                    cycle_results.append({'task': task.description, 'result': result, 'learning': experience})
+
+                experiences = await asyncio.gather(*[agent.integrate_experience(t) for t in wave], return_exceptions=True)
+                for task, experience in zip(wave, experiences):
+                    if isinstance(experience, Exception):
+                        experience = None
+                    cycle_results.append({'task': task.description, 'result': task.result, 'learning': experience})
+
+                # Entries were popped in heap order, so the deferred list is already a valid heap
+                pending = deferred
 
             agent._update_context()
-            jobs[job_id]['progress'] = (i + 1) / iterations
-            jobs[job_id]['details'][f'cycle_{i+1}'] = {
+            await job_store.update(job_id, ('progress',), (i + 1) / iterations)
+            await job_store.update(job_id, ('details', f'cycle_{i+1}'), {
                 'status': 'completed',
                 'assessment': assessment,
                 'results': cycle_results
-            }
+            })
 
-        jobs[job_id]['status'] = 'completed'
+        await job_store.update(job_id, ('status',), 'completed')
     except Exception as e:
-        jobs[job_id]['status'] = 'failed'
-        jobs[job_id]['details']['error'] = str(e)
+        log.exception("Agent run %s failed.", job_id)
+        await job_store.update(job_id, ('details', 'error'), str(e))
+        await job_store.update(job_id, ('status',), 'failed')
 
 
 # --- API Endpoints ---
@@ -93,18 +166,21 @@ async def run_pearl_cycle(job_id: str, goal: str, iterations: int):
 async def start_agent_run(request: AgentRunRequest, background_tasks: BackgroundTasks):
     """Starts a new PEARL agent run in the background."""
     job_id = str(uuid.uuid4())
-    jobs[job_id] = {
+    await job_store.create(job_id, {
         "status": "pending",
         "progress": 0.0,
         "details": {"goal": request.goal}
-    }
-    background_tasks.add_task(run_pearl_cycle, job_id, request.goal, request.iterations)
+    })
+    background_tasks.add_task(
+        run_pearl_cycle, job_id, request.goal, request.iterations,
+        app.state.memory_manager, app.state.prompt_cache
+    )
     return JobResponse(job_id=job_id, status="pending", message="Agent run started.")
 
 @app.get("/agent/status/{job_id}", response_model=JobStatusResponse)
 async def get_agent_status(job_id: str):
     """Retrieves the status and results of a specific agent run."""
-    job = jobs.get(job_id)
+    job = await job_store.get(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     return JobStatusResponse(**job)
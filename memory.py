@@ -1,60 +1,405 @@
 # memory.py
 import asyncio
-import chromadb
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+import faiss
+import numpy as np
 from chromadb.utils import embedding_functions
+from filelock import FileLock
+
+log = logging.getLogger(__name__)
+
+class VectorIndex:
+    """A persistent in-process FAISS index of documents, searched by cosine similarity.
+
+    Several API workers may share one directory: saves are serialized with a file lock and merge in
+    entries that other processes saved first, so no worker overwrites another's additions.
+    """
+    def __init__(self, db_directory: str, name: str, dimension: int = 384, index_type: str = "flat",
+                 max_entries: int | None = None, persist_interval: float = 30.0):
+        if max_entries is not None and index_type != "flat":
+            raise ValueError("max_entries requires a flat index; HNSW indexes do not support removal")
+        os.makedirs(db_directory, exist_ok=True)
+        self.db_directory = db_directory
+        self.name = name
+        self.path = os.path.join(db_directory, f"{name}.index")
+        self._file_lock = FileLock(self.path + ".lock")
+        self.max_entries = max_entries
+        self.persist_interval = persist_interval
+        self._last_save = time.monotonic()
+        self._dirty = False
+        # Vectors are L2-normalized, so inner product equals cosine similarity.
+        # Exact search is fastest below ~100K entries; use "hnsw" beyond that.
+        if index_type == "hnsw":
+            self.index = faiss.IndexHNSWFlat(dimension, 32, faiss.METRIC_INNER_PRODUCT)
+        else:
+            self.index = faiss.IndexFlatIP(dimension)
+        self.docs: list[str] = []
+        self.ids: list[str] = []
+        self.metadatas: list[dict | None] = []
+        self._id_pos: dict[str, int] = {}
+        # Ids in the file as this process last read or wrote it; only ids beyond these are merged on save,
+        # so entries this process evicted are not resurrected from its own earlier save
+        self._ids_on_disk: set[str] = set()
+        # FAISS indexes are not safe for concurrent reads and writes; these critical sections are short
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            self._load(self._read_file())
+
+    def count(self) -> int:
+        return len(self.docs)
+
+    @staticmethod
+    def _normalize(embeddings) -> np.ndarray:
+        vectors = np.asarray(embeddings, dtype="float32")
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def _read_file(self) -> dict:
+        with open(self.path, "rb") as f:
+            return pickle.load(f)
+
+    def _load(self, data: dict):
+        self.index = faiss.deserialize_index(data["index"])
+        self.docs, self.ids, self.metadatas = data["docs"], data["ids"], data["metadatas"]
+        self._id_pos = {doc_id: pos for pos, doc_id in enumerate(self.ids)}
+        self._ids_on_disk = set(self.ids)
+
+    def _append(self, vectors: np.ndarray, documents: list[str], ids: list[str], metadatas: list[dict | None]):
+        # Callers hold self._lock
+        self.index.add(vectors)
+        for doc, doc_id, metadata in zip(documents, ids, metadatas):
+            self._id_pos[doc_id] = len(self.ids)
+            self.docs.append(doc)
+            self.ids.append(doc_id)
+            self.metadatas.append(metadata)
+        self._evict()
+
+    def _evict(self):
+        # Callers hold self._lock. Drops the oldest entries once the index is over its size cap.
+        if self.max_entries is None or len(self.ids) <= self.max_entries:
+            return
+        excess = len(self.ids) - self.max_entries
+        self.index.remove_ids(np.arange(excess, dtype="int64"))
+        del self.docs[:excess], self.ids[:excess], self.metadatas[:excess]
+        self._id_pos = {doc_id: pos for pos, doc_id in enumerate(self.ids)}
+
+    def add(self, documents: list[str], embeddings, ids: list[str], metadatas: list[dict | None] | None = None,
+            upsert: bool = False):
+        """Adds new documents. Saves if `persist_interval` has elapsed.
+
+        Ids already present are skipped, or with `upsert` have their metadata replaced (ids are content
+        digests, so the document and vector are already the same).
+        """
+        metadatas = metadatas or [None] * len(documents)
+        with self._lock:
+            new = []
+            for i, doc_id in enumerate(ids):
+                pos = self._id_pos.get(doc_id)
+                if pos is None:
+                    new.append(i)
+                elif upsert:
+                    self.metadatas[pos] = metadatas[i]
+            if new:
+                vectors = self._normalize(embeddings)[new]
+                self._append(vectors, [documents[i] for i in new], [ids[i] for i in new], [metadatas[i] for i in new])
+            self._dirty = True
+        if time.monotonic() - self._last_save >= self.persist_interval:
+            self.save()
+
+    def query(self, query_embeddings, n_results: int, where: dict | None = None) -> list[tuple[float, str, dict | None]]:
+        """Returns (cosine distance, document, metadata) for the nearest documents to the first query.
+
+        If `where` is given, only documents whose metadata has exactly those values are searched.
+        """
+        query = self._normalize(query_embeddings)
+        with self._lock:
+            params = None
+            if where:
+                matches = [pos for pos, metadata in enumerate(self.metadatas)
+                           if metadata and all(metadata.get(k) == v for k, v in where.items())]
+                if not matches:
+                    return []
+                params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(np.asarray(matches, dtype=np.int64)))
+            scores, positions = self.index.search(query, n_results, params=params)
+            return [(1.0 - float(score), self.docs[pos], self.metadatas[pos])
+                    for score, pos in zip(scores[0], positions[0]) if pos != -1]
+
+    def save(self):
+        """Merges in entries other processes have saved, then atomically writes the index to disk."""
+        with self._file_lock:
+            # Only the owner's write thread mutates the index, so other processes' entries can be
+            # prepared here without holding the lock that queries wait on
+            merged = self._entries_from_other_processes(self._read_file()) if os.path.exists(self.path) else None
+            with self._lock:
+                if merged is not None:
+                    self._append(*merged)
+                # Snapshot under the lock; the disk write below runs without blocking queries
+                snapshot = {
+                    "index": faiss.serialize_index(self.index),
+                    "docs": list(self.docs),
+                    "ids": list(self.ids),
+                    "metadatas": list(self.metadatas),
+                }
+                self._ids_on_disk = set(self.ids)
+                self._dirty = False
+                self._last_save = time.monotonic()
+            # One file replaced in one step, so the index and its documents can never disagree
+            fd, tmp_path = tempfile.mkstemp(dir=self.db_directory, prefix=f"{self.name}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(snapshot, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    def _entries_from_other_processes(self, data: dict) -> tuple | None:
+        """Returns `_append` arguments for entries another process saved since this one last read or wrote the file."""
+        missing = [pos for pos, doc_id in enumerate(data["ids"])
+                   if doc_id not in self._id_pos and doc_id not in self._ids_on_disk]
+        if not missing:
+            return None
+        disk_index = faiss.deserialize_index(data["index"])
+        vectors = np.vstack([disk_index.reconstruct(pos) for pos in missing])
+        return (vectors, [data["docs"][pos] for pos in missing],
+                [data["ids"][pos] for pos in missing], [data["metadatas"][pos] for pos in missing])
+
+    def save_if_dirty(self):
+        if self._dirty:
+            self.save()
+
+
+class LRUEmbeddingCache:
+    """Wraps an embedding function with an LRU cache keyed on the input text."""
+    def __init__(self, inner, size: int = 2048):
+        self.inner = inner
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+        self._size = size
+        # Called from executor threads, so cache bookkeeping is guarded; the model runs outside the lock
+        self._lock = threading.Lock()
+
+    def __call__(self, texts: list[str]) -> list:
+        out = []
+        misses, miss_idx = [], []
+        with self._lock:
+            for i, text in enumerate(texts):
+                vector = self._cache.get(text)
+                if vector is None:
+                    miss_idx.append(i); misses.append(text); out.append(None)
+                else:
+                    self._cache.move_to_end(text); out.append(vector)
+
+        if misses:
+            vectors = self.inner(misses)
+            with self._lock:
+                for text, vector, idx in zip(misses, vectors, miss_idx):
+                    out[idx] = vector
+                    self._cache[text] = vector
+                    if len(self._cache) > self._size:
+                        self._cache.popitem(last=False)
+        return out
+
 
 class MemoryManager:
-    """Manages the agent's long-term memory using ChromaDB with async support."""
-    def __init__(self, db_directory: str, collection_name: str):
-        print("Initializing memory manager...")
-        self.client = chromadb.PersistentClient(path=db_directory)
-        self.embedding_function = embedding_functions.DefaultEmbeddingFunction()
-        self.collection = self.client.get_or_create_collection(
-            name=collection_name,
-            embedding_function=self.embedding_function,
-            metadata={"hnsw:space": "cosine"}
-        )
-        # Mutex to ensure only one async task writes to the DB at a time
-        self.lock = asyncio.Lock()
-        print("Memory manager initialized.")
+    """Manages the agent's long-term memory using a FAISS vector index with async support."""
+    def __init__(self, db_directory: str, collection_name: str, index_type: str = "flat", flush_batch_size: int = 16, flush_interval: float = 0.5):
+        log.info("Initializing memory manager...")
+        self.db_directory = db_directory
+        # Cached so repeated memory texts and queries skip the ONNX model
+        self.embedding_function = LRUEmbeddingCache(embedding_functions.DefaultEmbeddingFunction())
+        self.index = VectorIndex(db_directory, collection_name, index_type=index_type)
+        # A single write thread serializes index writes without an app-level lock or blocking the event loop
+        self._write_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-writer")
+        # New memories are buffered and indexed in batches by a background flusher
+        self.flush_batch_size = flush_batch_size
+        self.flush_interval = flush_interval
+        self._pending_docs: list[str] = []
+        self._pending_ids: list[str] = []
+        self._buffer_lock = asyncio.Lock()
+        self._pending_event = asyncio.Event() # Set while the buffer holds memories
+        self._flush_event = asyncio.Event() # Set when a batch fills up or the manager is closing
+        self._closing = False
+        self._flusher: asyncio.Task | None = None
+        # Ids already stored or buffered, so duplicate learnings are dropped before any embedding work
+        self._seen_ids: set[str] = set(self.index.ids)
+        log.info("Memory manager initialized.")
 
     async def add_memory(self, task_description: str, learning: str):
-        """Adds a new memory to the collection in an async-safe manner."""
+        """Queues a new memory for the next batched write to the index."""
         memory_text = f"From the task '{task_description}', I learned: {learning}"
-        memory_id = str(hash(memory_text))
+        # A stable digest (unlike the per-process salted hash()) makes writes idempotent across restarts
+        memory_id = hashlib.sha256(memory_text.encode()).hexdigest()[:32]
         
-        async with self.lock:
-            # This block is the critical section protected by the mutex
+        async with self._buffer_lock:
+            if memory_id in self._seen_ids:
+                return
+            self._seen_ids.add(memory_id)
+            self._pending_docs.append(memory_text)
+            self._pending_ids.append(memory_id)
+            self._pending_event.set()
+            batch_full = len(self._pending_docs) >= self.flush_batch_size
+
+        # The flusher is started lazily because it needs a running event loop
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+        if batch_full:
+            self._flush_event.set()
+
+    async def _flush_loop(self):
+        """Flushes buffered memories `flush_interval` seconds after they arrive, or as soon as a batch fills up."""
+        while not self._closing:
+            # Idle, without waking up, until something is buffered
+            await self._pending_event.wait()
             try:
-                self.collection.add(
-                    documents=[memory_text],
-                    ids=[memory_id]
-                )
-                print(f"MEMORY: Added learning to collection: '{learning[:50]}...'")
-            except Exception as e:
-                print(f"Error adding memory: {e}")
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self._write_pending()
+
+    async def _write_pending(self) -> bool:
+        """Writes the buffered memories as one batch; returns False if the buffer was empty."""
+        async with self._buffer_lock:
+            if not self._pending_docs:
+                return False
+            batch_docs, batch_ids = self._pending_docs, self._pending_ids
+            self._pending_docs, self._pending_ids = [], []
+            self._pending_event.clear()
+            # Submitted while the buffer lock is held, so the write thread sees batches in swap order
+            write = asyncio.get_running_loop().run_in_executor(self._write_pool, lambda: self.index.add(
+                documents=batch_docs,
+                embeddings=self.embedding_function(batch_docs),
+                ids=batch_ids
+            ))
+
+        try:
+            # Shielded: cancelling the caller must not cancel a queued write whose ids are already in _seen_ids
+            await asyncio.shield(write)
+            log.debug("Added %d learnings to the index.", len(batch_docs))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error("Error adding memories: %s", e)
+            # Let these memories be retried the next time they are learned
+            async with self._buffer_lock:
+                self._seen_ids.difference_update(batch_ids)
+        return True
+
+    async def flush(self):
+        """Writes all buffered memories to the index in a single batch.
+
+        Also waits for a batch another caller is still writing, so on return every memory added before the
+        call is searchable.
+        """
+        if not await self._write_pending():
+            # Any batch swapped out earlier is already queued on the single write thread ahead of this no-op
+            await asyncio.shield(asyncio.get_running_loop().run_in_executor(self._write_pool, lambda: None))
+
+    async def close(self):
+        """Stops the background flusher, writes any remaining buffered memories and stops the write thread."""
+        if self._flusher is not None:
+            # Let the flusher finish its current write and exit rather than cancelling it mid-write
+            self._closing = True
+            self._pending_event.set()
+            self._flush_event.set()
+            await self._flusher
+            self._flusher = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._write_pool, self.index.save_if_dirty)
+        self._write_pool.shutdown(wait=True)
 
     async def retrieve_relevant_memories(self, query: str, n_results: int = 3) -> str:
         """Retrieves the most relevant memories for a given query."""
-        # This operation is read-only and generally thread-safe in Chroma,
-        # so we don't need a lock here, which improves performance.
-        if self.collection.count() == 0:
+        # Reads don't go through the write thread; the index guards itself for the brief search.
+        # Embedding and search are blocking, so they run in the default executor to keep the event loop free.
+        # Make sure memories still sitting in the write buffer are searchable
+        await self.flush()
+        count = self.index.count()
+        if count == 0:
             return "No memories available yet."
             
         try:
-            results = self.collection.query(
-                query_texts=[query],
-                n_results=min(n_results, self.collection.count())
-            )
-            memories = results['documents'][0]
+            results = await asyncio.get_running_loop().run_in_executor(None, lambda: self.index.query(
+                query_embeddings=self.embedding_function([query]),
+                n_results=min(n_results, count)
+            ))
+            memories = [doc for _, doc, _ in results]
             if not memories: return "No relevant memories found."
 
             formatted_memories = "Relevant Past Learnings:\n"
             for mem in memories:
                 formatted_memories += f"- {mem}\n"
             
-            print(f"MEMORY: Retrieved {len(memories)} relevant memories for query: '{query}'")
+            log.debug("Retrieved %d relevant memories for query: '%s'", len(memories), query)
             return formatted_memories
         except Exception as e:
-            print(f"Error retrieving memories: {e}")
+            log.error("Error retrieving memories: %s", e)
             return "Could not retrieve memories due to an error."
+
+
+class SemanticPromptCache:
+    """Caches LLM responses, so near-duplicate prompts skip the API.
+
+    Entries are looked up by an exact `key` (e.g. the goal or task) plus the embedding of the prompt's
+    variable `text` (e.g. the memories or result). Only the variable text is embedded: the fixed template
+    would dominate the embedding, and MiniLM truncates to 256 wordpieces, so prompts for different goals
+    would otherwise collide.
+    """
+    def __init__(self, db_directory: str, embedding_function, collection_name: str = "prompt_cache",
+                 distance_threshold: float = 0.05, max_entries: int = 10000):
+        self.embedding_function = embedding_function
+        self.distance_threshold = distance_threshold
+        # Capped so the cache (and its save cost) stays bounded; the oldest entries are evicted first
+        self.index = VectorIndex(db_directory, collection_name, max_entries=max_entries)
+        # Dedicated write thread, kept separate from the memory manager's so cache writes never queue behind memories
+        self._write_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prompt-cache-writer")
+
+    async def lookup(self, key: str, text: str) -> str | None:
+        """Returns the cached response stored under `key` for a semantically equivalent `text`, if any."""
+        if self.index.count() == 0:
+            return None
+
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(None, lambda: self.index.query(
+                query_embeddings=self.embedding_function([text]),
+                n_results=1,
+                where={"key": key}
+            ))
+            if not results:
+                return None
+            distance, _, metadata = results[0]
+            if distance >= self.distance_threshold:
+                log.debug("Prompt cache miss (nearest distance %.4f).", distance)
+                return None
+            log.debug("Prompt cache hit (distance %.4f), skipping API call.", distance)
+            return metadata['response']
+        except Exception as e:
+            log.error("Error querying prompt cache: %s", e)
+            return None
+
+    async def store(self, key: str, text: str, response_text: str):
+        """Stores a response under `key` and `text`, replacing any earlier response for the same pair."""
+        entry_id = hashlib.sha256(f"{key}\0{text}".encode()).hexdigest()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._write_pool, lambda: self.index.add(
+                documents=[text],
+                embeddings=self.embedding_function([text]),
+                ids=[entry_id],
+                metadatas=[{"key": key, "response": response_text}],
+                upsert=True
+            ))
+        except Exception as e:
+            log.error("Error adding to prompt cache: %s", e)
+
+    async def close(self):
+        """Saves any unsaved cache entries and stops the write thread."""
+        await asyncio.get_running_loop().run_in_executor(self._write_pool, self.index.save_if_dirty)
+        self._write_pool.shutdown(wait=True)
@@ -0,0 +1,19 @@
+# metrics.py
+import numpy as np
+
+class LatencyHistogram:
+    """Keeps the most recent latency samples in a fixed-size ring buffer and reports percentiles."""
+    def __init__(self, size: int = 1024):
+        self._samples = np.zeros(size, dtype=np.float64)
+        self._count = 0
+
+    def observe(self, seconds: float):
+        self._samples[self._count % len(self._samples)] = seconds
+        self._count += 1
+
+    def percentiles(self, qs: tuple[float, ...] = (50, 95, 99)) -> dict[str, float]:
+        """Returns e.g. {"p50": ..., "p95": ..., "p99": ...} in seconds, or {} before any samples."""
+        samples = self._samples[:min(self._count, len(self._samples))]
+        if samples.size == 0:
+            return {}
+        return {f"p{q:g}": float(v) for q, v in zip(qs, np.percentile(samples, qs))}
@@ -1,13 +1,30 @@
 # pearl_agent.py
 import google.generativeai as genai
-import json
+import orjson
+import re
 import time
 import asyncio
-from typing import Dict, List, Any
+import logging
+from typing import Dict, List, Any, Awaitable, Tuple
 # (Task and TaskStatus dataclasses remain the same as before)
 from enum import Enum
 from dataclasses import dataclass, asdict, field
 
+from rate_limiter import RateLimiter
+from metrics import LatencyHistogram
+
+log = logging.getLogger(__name__)
+
+# Gemini round-trip latency across all agents, used to tune the prompt cache and rate limits
+GEMINI_LATENCY = LatencyHistogram()
+
+# Prompt size budgets. LLM latency and TPM usage grow with input size, so these bound both
+# as the context and task results grow across cycles (~4 characters per token).
+MAX_CONTEXT_CHARS = 2000
+MAX_RESULT_CHARS = 2000
+
+_SENTENCE_END = re.compile(r"[.!?](?=\s)")
+
 class TaskStatus(Enum):
     PENDING = "pending"; IN_PROGRESS = "in_progress"; COMPLETED = "completed"; FAILED = "failed"
 
@@ -18,119 +35,229 @@ class Task:
     dependencies: List[str] = field(default_factory=list)
     result: str | None = None; tool: str | None = None; tool_input: str | None = None
 
+def _strip_fences(text: str) -> str:
+    """Removes the markdown code fence the model tends to wrap JSON in."""
+    # Literal prefix/suffix checks: str.lstrip/rstrip would strip any of the characters, mangling e.g. "null"
+    text = text.strip()
+    if text.startswith("```json"):
+        text = text[7:].strip()
+    elif text.startswith("```"):
+        text = text[3:].strip()
+    if text.endswith("```"):
+        text = text[:-3].strip()
+    return text
+
+def _truncate_text(text: str, max_chars: int) -> str:
+    """Cuts text to at most `max_chars`, preferring the last sentence boundary in the second half."""
+    if len(text) <= max_chars:
+        return text
+    head = text[:max_chars]
+    ends = [m.end() for m in _SENTENCE_END.finditer(head, max_chars // 2)]
+    return head[:ends[-1] if ends else max_chars] + "…"
+
+def _task_from_json(raw: Any, default_priority: int = 1) -> Task:
+    """Builds a Task from one element of the model's task list.
+
+    The priority orders the scheduler's heap, so it must be an int: numeric strings such as "5" are converted,
+    and anything else (e.g. "high" or a missing value) becomes `default_priority` instead of failing the job.
+    """
+    if not isinstance(raw, dict):
+        raise TypeError(f"task is not a JSON object: {raw!r}")
+    priority = raw.get("priority")
+    try:
+        if isinstance(priority, bool):
+            raise TypeError("priority is a boolean")
+        priority = int(float(priority))
+    except (TypeError, ValueError, OverflowError):
+        priority = default_priority
+    return Task(**{**raw, "priority": priority})
+
 class PEARLAgent:
-    """Async PEARL Agent with API call Semaphore"""
+    """Async PEARL Agent with API call rate limiting"""
 
-    def __init__(self, api_key: str, model_name: str, memory_manager, tools: Dict, api_call_semaphore: asyncio.Semaphore):
+    def __init__(self, api_key: str, model_name: str, memory_manager, tools: Dict, rate_limiter: RateLimiter, prompt_cache=None):
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel(model_name)
         self.memory_manager = memory_manager
         self.tools = tools
-        self.api_call_semaphore = api_call_semaphore # Semaphore to limit concurrent API calls
+        self.rate_limiter = rate_limiter # Token bucket shared across agents to respect RPM/TPM quotas
+        self.prompt_cache = prompt_cache # Optional semantic cache of prompt -> response
         self.tasks: Dict[str, Task] = {}
         self.context: Dict[str, Any] = {"completed_tasks": 0, "total_tasks": 0}
+        # Serialized once and reused by every prompt; refreshed only when the context changes
+        self._context_json = orjson.dumps(self.context, option=orjson.OPT_INDENT_2).decode()
+        self._tools_json = orjson.dumps(list(self.tools.keys())).decode()
+
+    async def _cached_response(self, key: str, text: str) -> str | None:
+        """Returns the cached response for a prompt, if there is a prompt cache and it has one.
+
+        `key` must match exactly (e.g. the goal or task); `text` is the prompt's variable part, matched semantically.
+        """
+        if self.prompt_cache is None:
+            return None
+        return await self.prompt_cache.lookup(key, text)
+
+    async def _cache_response(self, key: str, text: str, response_text: str):
+        """Caches a response. Callers only do so once they have parsed it successfully, so a reply
+        they had to fall back on is never replayed for later prompts."""
+        if self.prompt_cache is not None:
+            await self.prompt_cache.store(key, text, response_text)
 
     async def _generate_content_with_semaphore(self, prompt: str) -> str:
-        """Wrapper to call the Gemini API, respecting the semaphore."""
-        async with self.api_call_semaphore:
-            print("SEMAPHORE: Acquired lock for API call.")
-            response = await self.model.generate_content_async(prompt)
-            print("SEMAPHORE: Released lock for API call.")
-            return response.text.strip().lstrip("```json").rstrip("```")
-
-    async def self_assess(self, goal: str) -> Dict[str, Any]:
-        """S: Self-Assessment - Evaluate current state, capabilities, and memories."""
-        relevant_memories = await self.memory_manager.retrieve_relevant_memories(goal)
-        assessment_prompt = f"""
-        You are an AI agent conducting self-assessment. Respond ONLY with valid JSON.
+        """Wrapper to call the Gemini API, respecting the rate limiter.
+
+        The response is streamed and always read to the end, so the stream is closed cleanly.
+        """
+        # Rough token estimate: ~4 characters per prompt token plus headroom for the response
+        await self.rate_limiter.aacquire(tokens=len(prompt) // 4 + 512)
+        t0 = time.perf_counter()
+        try:
+            stream = await self.model.generate_content_async(prompt, stream=True)
+            chunks = []
+            async for chunk in stream:
+                chunks.append(chunk.text)
+        finally:
+            # Failed and timed-out calls count too, or the histogram would under-report tail latency
+            latency = time.perf_counter() - t0
+            GEMINI_LATENCY.observe(latency)
+            log.debug("Gemini call took %.3fs.", latency)
+        return _strip_fences("".join(chunks))
+
+    async def assess_and_plan(self, goal: str, relevant_memories: Awaitable[str] | None = None) -> Tuple[Dict[str, Any], List[Task]]:
+        """S+A: Self-assessment and adaptive planning fused into a single API call.
+
+        Planning only needs the assessment it follows, so asking for both at once saves a round-trip per cycle.
+        `relevant_memories` may be a prefetched retrieval (e.g. an asyncio.Task) started by the caller.
+        """
+        if relevant_memories is None:
+            relevant_memories = self.memory_manager.retrieve_relevant_memories(goal)
+        relevant_memories = await relevant_memories
+        context = self._truncate_context()
+        prompt = f"""
+        You are an AI agent that first assesses its progress toward a goal and then plans the next tasks. Respond ONLY with a valid JSON object.
 
         GOAL: {goal}
-        CURRENT_CONTEXT: {json.dumps(self.context, indent=2)}
+        CURRENT_CONTEXT: {context}
         RELEVANT_MEMORIES:
         {relevant_memories}
+        AVAILABLE_TOOLS: {self._tools_json}
 
-        Provide your assessment as a JSON object with these exact keys:
-        {{
-            "progress_score": <number 0-100 indicating closeness to the goal>,
-            "gaps": ["list of knowledge or capability gaps"],
-            "risks": ["list of potential risks or obstacles"],
-            "recommendations": ["list of high-level next steps"]
-        }}
-        """
-        
-        response_text = await self._generate_content_with_semaphore(assessment_prompt)
-        try:
-            return json.loads(response_text)
-        except (json.JSONDecodeError, AttributeError) as e:
-            print(f"Assessment parsing error: {e}. Using default."); return {"progress_score": 10, ...}
+        1. Assess the current state: closeness to the goal, knowledge or capability gaps, risks, and high-level next steps.
+        2. Based on that assessment, create 2-3 actionable tasks to advance the goal. Tasks can either be research/analysis questions for the AI, or a specific action using an available tool.
 
-    async def adaptive_plan(self, goal: str, assessment: Dict[str, Any]) -> List[Task]:
-        """A: Adaptive Planning - Create dynamic, context-aware task decomposition."""
-        planning_prompt = f"""
-        You are an AI task planner. Respond ONLY with a valid JSON array of tasks.
-
-        MAIN_GOAL: {goal}
-        ASSESSMENT: {json.dumps(assessment, indent=2)}
-        AVAILABLE_TOOLS: {json.dumps(list(self.tools.keys()))}
-        
-        Create 2-3 actionable tasks to advance the goal. Tasks can either be research/analysis questions for the AI, or a specific action using an available tool.
-        
         - For a tool-based task, set "tool" to the tool's name and "tool_input" to what it needs.
         - For a general AI task, leave "tool" and "tool_input" as null.
         - Ensure task IDs are unique strings (e.g., "task_1", "task_2").
 
-        JSON array format:
-        [
-            {{
-                "id": "task_1",
-                "description": "Research the core principles of sustainable urban gardening.",
-                "priority": 5,
-                "dependencies": [],
-                "tool": null,
-                "tool_input": null
+        JSON object format:
+        {{
+            "assessment": {{
+                "progress_score": <number 0-100 indicating closeness to the goal>,
+                "gaps": ["list of knowledge or capability gaps"],
+                "risks": ["list of potential risks or obstacles"],
+                "recommendations": ["list of high-level next steps"]
             }},
-            {{
-                "id": "task_2",
-                "description": "Find recent articles on vertical farming techniques.",
-                "priority": 4,
-                "dependencies": [],
-                "tool": "web_search",
-                "tool_input": "recent developments in vertical farming techniques 2025"
-            }}
-        ]
+            "tasks": [
+                {{
+                    "id": "task_1",
+                    "description": "Research the core principles of sustainable urban gardening.",
+                    "priority": 5,
+                    "dependencies": [],
+                    "tool": null,
+                    "tool_input": null
+                }},
+                {{
+                    "id": "task_2",
+                    "description": "Find recent articles on vertical farming techniques.",
+                    "priority": 4,
+                    "dependencies": [],
+                    "tool": "web_search",
+                    "tool_input": "recent developments in vertical farming techniques 2025"
+                }}
+            ]
+        }}
         """
-        response_text = await self._generate_content_with_semaphore(planning_prompt)
+        # The goal and context must match exactly; the retrieved memories may differ slightly
+        cache_key = f"assess_and_plan\n{goal}\n{context}"
+        response_text = await self._cached_response(cache_key, relevant_memories)
+        from_cache = response_text is not None
+        if not from_cache:
+            response_text = await self._generate_content_with_semaphore(prompt)
+        try:
+            data = orjson.loads(response_text)
+        except orjson.JSONDecodeError as e:
+            log.warning("Response parsing error: %s.", e)
+            data = {}
+        if not isinstance(data, dict):
+            log.warning("Response is not a JSON object.")
+            data = {}
+
+        # Each part falls back on its own, so a usable plan survives a missing assessment and vice versa
+        parsed = True
+        assessment = data.get("assessment")
+        if not isinstance(assessment, dict):
+            log.warning("Assessment missing from response. Using default.")
+            assessment = {"progress_score": 10, "gaps": [], "risks": [], "recommendations": []}
+            parsed = False
         try:
-            task_data = json.loads(response_text)
-            return [Task(**data) for data in task_data]
-        except (json.JSONDecodeError, TypeError, AttributeError) as e:
-            print(f"Planning parsing error: {e}. Using fallback."); return [Task(id="fallback", ...)]
+            if not isinstance(data["tasks"], list):
+                raise TypeError("'tasks' is not a list")
+            tasks = [_task_from_json(task) for task in data["tasks"]]
+        except (KeyError, TypeError) as e:
+            log.warning("Planning parsing error: %s. Using fallback.", e)
+            tasks = [Task(id="fallback", description=f"Research the goal: {goal}", priority=1)]
+            parsed = False
+
+        if parsed and not from_cache:
+            await self._cache_response(cache_key, relevant_memories, response_text)
+        return assessment, tasks
+
+    async def self_assess(self, goal: str, relevant_memories: Awaitable[str] | None = None) -> Dict[str, Any]:
+        """S: Self-Assessment - Evaluate current state, capabilities, and memories. Delegates to `assess_and_plan`."""
+        return (await self.assess_and_plan(goal, relevant_memories))[0]
+
+    async def adaptive_plan(self, goal: str, assessment: Dict[str, Any]) -> List[Task]:
+        """A: Adaptive Planning - Create dynamic, context-aware task decomposition. Delegates to `assess_and_plan`.
+
+        `assessment` is accepted for compatibility only: the plan is made together with a fresh assessment.
+        """
+        return (await self.assess_and_plan(goal))[1]
 
     async def execute_goal_oriented(self, task: Task) -> str:
         """G: Goal-oriented Execution - Execute a task using tools or AI reasoning."""
         if task.tool and task.tool in self.tools:
             tool_function = self.tools[task.tool]
-            # Assuming tools are synchronous for now. Can be made async if they do I/O.
-            return tool_function(task.tool_input)
+            if asyncio.iscoroutinefunction(tool_function):
+                return await tool_function(task.tool_input)
+            # Synchronous tools do blocking I/O, so they run in a worker thread to keep the event loop free
+            return await asyncio.to_thread(tool_function, task.tool_input)
         else:
             # Execute a reasoning/text-generation task
+            context = self._truncate_context()
             execution_prompt = f"""
             As an AI agent, execute the following task. Provide a comprehensive, direct, and actionable result.
 
             Task: {task.description}
-            Context: {json.dumps(self.context, indent=2)}
+            Context: {context}
 
             Focus on producing a clear and thorough response to fulfill the task's requirements.
             """
-            return await self._generate_content_with_semaphore(execution_prompt)
+            cache_key = f"execute\n{task.description}"
+            result = await self._cached_response(cache_key, context)
+            if result is None:
+                result = await self._generate_content_with_semaphore(execution_prompt)
+                if result:
+                    await self._cache_response(cache_key, context, result)
+            return result
 
     async def integrate_experience(self, task: Task) -> Dict[str, Any]:
         """E: Experience Integration - Learn from outcomes and update knowledge."""
+        result = _truncate_text(task.result, MAX_RESULT_CHARS)
         integration_prompt = f"""
         You are a learning AI. Reflect on the completed task and its result. Respond ONLY with valid JSON.
 
         TASK: {task.description}
-        RESULT: {task.result[:500]}...
+        RESULT: {result}
         STATUS: {task.status.value}
 
         Provide learning insights as a JSON object:
@@ -140,19 +267,36 @@ class PEARLAgent:
             "confidence_boost": <number from -10 to 10 reflecting change in confidence>
         }}
         """
-        response_text = await self._generate_content_with_semaphore(integration_prompt)
+        cache_key = f"integrate_experience\n{task.description}\n{task.status.value}"
+        response_text = await self._cached_response(cache_key, result)
+        from_cache = response_text is not None
+        if not from_cache:
+            response_text = await self._generate_content_with_semaphore(integration_prompt)
         try:
-            experience = json.loads(response_text)
-            if task.status == TaskStatus.COMPLETED and experience.get("learnings"):
-                await self.memory_manager.add_memory(task.description, experience["learnings"][0])
-            return experience
-        except (json.JSONDecodeError, AttributeError) as e:
-            print(f"Experience parsing error: {e}. Using default."); return {"learnings": [...], ...}
+            experience = orjson.loads(response_text)
+            learnings = experience["learnings"]
+            if not isinstance(learnings, list):
+                raise TypeError("'learnings' is not a list")
+        except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+            log.warning("Experience parsing error: %s. Using default.", e); return {"learnings": [], "adjustments": [], "confidence_boost": 0}
+
+        if not from_cache:
+            await self._cache_response(cache_key, result, response_text)
+        if task.status == TaskStatus.COMPLETED and learnings:
+            await self.memory_manager.add_memory(task.description, learnings[0])
+        return experience
     
     # _dependencies_met and _update_context methods do not need to be async
     def _dependencies_met(self, task: Task) -> bool:
         return all(dep_id not in self.tasks or self.tasks[dep_id].status == TaskStatus.COMPLETED for dep_id in task.dependencies)
 
+    def _truncate_context(self, max_chars: int = MAX_CONTEXT_CHARS) -> str:
+        """Returns the serialized context, cut to `max_chars` if it has grown beyond the prompt budget."""
+        if len(self._context_json) <= max_chars:
+            return self._context_json
+        return self._context_json[:max_chars] + "…"
+
     def _update_context(self):
         completed_count = sum(1 for t in self.tasks.values() if t.status == TaskStatus.COMPLETED)
         self.context.update({"completed_tasks": completed_count, "total_tasks": len(self.tasks)})
+        self._context_json = orjson.dumps(self.context, option=orjson.OPT_INDENT_2).decode()
@@ -0,0 +1,47 @@
+# rate_limiter.py
+import asyncio
+import threading
+import time
+
+class RateLimiter:
+    """Token-bucket limiter enforcing both requests-per-minute and tokens-per-minute quotas."""
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # Both buckets start full so an initial burst goes through immediately
+        self._req_tokens = float(requests_per_minute)
+        self._tok_tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        # Critical sections are pure arithmetic, so a threading lock is safe to take from async code
+        self._lock = threading.Lock()
+        # Waiters queue here; asyncio.Lock wakes them in arrival order
+        self._queue = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._req_tokens = min(self.requests_per_minute, self._req_tokens + elapsed * self.requests_per_minute / 60)
+        self._tok_tokens = min(self.tokens_per_minute, self._tok_tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def aacquire(self, tokens: int = 1):
+        """Waits until one request and `tokens` tokens are available, then consumes them.
+
+        Callers are served in FIFO order, so a large request is never starved by smaller ones that arrive later.
+        """
+        # A single call can never need more than a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        # Only the caller at the head of the queue waits on the buckets; the rest wait their turn
+        async with self._queue:
+            while True:
+                with self._lock:
+                    self._refill()
+                    if self._req_tokens >= 1 and self._tok_tokens >= tokens:
+                        self._req_tokens -= 1
+                        self._tok_tokens -= tokens
+                        return
+                    req_wait = (1 - self._req_tokens) * 60 / self.requests_per_minute
+                    tok_wait = (tokens - self._tok_tokens) * 60 / self.tokens_per_minute
+                    wait = max(req_wait, tok_wait, 0)
+                # Never sleep while holding the lock
+                await asyncio.sleep(wait)
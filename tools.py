@@ -1,10 +1,16 @@
 # tools.py
 import json
-from duckduckgo_search import DDGS
+import logging
+from duckduckgo_search import AsyncDDGS
 
-print("Initializing tools...")
+log = logging.getLogger(__name__)
 
-def perform_web_search(query: str) -> str:
+log.info("Initializing tools...")
+
+# A single long-lived client, so connections, TLS sessions and DNS lookups are reused across searches
+_ddgs: AsyncDDGS | None = None
+
+async def perform_web_search(query: str) -> str:
     """
     Performs a web search using the DuckDuckGo Search API and returns the top results.
 
@@ -14,20 +20,22 @@ def perform_web_search(query: str) -> str:
     Returns:
         A formatted string of the top search results or an error message.
     """
+    global _ddgs
     try:
-        print(f"TOOL: Performing web search for query: '{query}'")
-        with DDGS() as ddgs:
-            results = [r for r in ddgs.text(query, max_results=5)]
-            if not results:
-                return "No results found."
-            
-            # Format the results for the LLM
-            formatted_results = "Search Results:\n"
-            for r in results:
-                formatted_results += f"- Title: {r.get('title', 'N/A')}\n"
-                formatted_results += f"  Snippet: {r.get('body', 'N/A')}\n"
-                formatted_results += f"  Link: {r.get('href', 'N/A')}\n\n"
-            return formatted_results
+        log.debug("Performing web search for query: '%s'", query)
+        if _ddgs is None:
+            _ddgs = AsyncDDGS()
+        results = await _ddgs.atext(query, max_results=5)
+        if not results:
+            return "No results found."
+        
+        # Format the results for the LLM
+        formatted_results = "Search Results:\n"
+        for r in results:
+            formatted_results += f"- Title: {r.get('title', 'N/A')}\n"
+            formatted_results += f"  Snippet: {r.get('body', 'N/A')}\n"
+            formatted_results += f"  Link: {r.get('href', 'N/A')}\n\n"
+        return formatted_results
     except Exception as e:
         return f"Error during web search: {e}"
 
@@ -35,4 +43,4 @@ def perform_web_search(query: str) -> str:
 available_tools = {
     "web_search": perform_web_search,
 }
-print("Tools initialized.")
+log.info("Tools initialized.")